@@ -0,0 +1,77 @@
+"""Fit the PCA projection used by main.py to shrink face descriptors.
+
+Reads the raw 16384-dim encodings of everyone registered so far from
+db/encodings.dat, fits a PCA and writes db/proj.npy (components) and
+db/proj_mean.npy. Restart the service afterwards; it rebuilds a projected
+encoding store from the raw one on startup.
+
+    python fit_projection.py --components 256
+
+The projected space is mean-centered, so cosine scores there are not on the
+raw scale: re-tune MATCH_THRESHOLD (env var read by main.py) after each fit.
+"""
+import argparse
+import os
+import sqlite3
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+DB_PATH = 'db/face_encodings.db'
+RAW_ENCODINGS_PATH = 'db/encodings.dat'
+PROJECTION_PATH = 'db/proj.npy'
+PROJECTION_MEAN_PATH = 'db/proj_mean.npy'
+RAW_DESCRIPTOR_DIM = 128 * 128
+# Fewer components than this cannot separate faces: every query lands near
+# someone, so a fit is refused rather than shrunk below it
+MIN_COMPONENTS = 64
+
+
+def load_raw_descriptors():
+    """Return the raw int8 encodings of all registered people as unit-norm float32 rows"""
+    conn = sqlite3.connect(DB_PATH)
+    rows = [r[0] for r in conn.execute('SELECT row_index FROM person WHERE row_index IS NOT NULL')]
+    conn.close()
+    if not rows or not os.path.exists(RAW_ENCODINGS_PATH):
+        return np.empty((0, RAW_DESCRIPTOR_DIM), dtype=np.float32)
+    mm = np.memmap(RAW_ENCODINGS_PATH, dtype=np.int8, mode='r').reshape(-1, RAW_DESCRIPTOR_DIM)
+    missing = [r for r in rows if r >= len(mm)]
+    if missing:
+        print(f'Skipping {len(missing)} rows missing from {RAW_ENCODINGS_PATH}')
+    X = mm[sorted(r for r in rows if r < len(mm))].astype(np.float32)
+    # All-zero rows were never written (registered before raw rows were kept)
+    X = X[np.any(X != 0, axis=1)]
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return np.divide(X, norms, out=np.zeros_like(X), where=norms > 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--components', type=int, default=256)
+    args = parser.parse_args()
+
+    X = load_raw_descriptors()
+    if args.components < MIN_COMPONENTS:
+        raise SystemExit(f'--components must be at least {MIN_COMPONENTS}')
+    # PCA cannot return more components than samples
+    n_components = min(args.components, len(X))
+    if n_components < MIN_COMPONENTS:
+        raise SystemExit(f'Need at least {MIN_COMPONENTS} registered faces to fit a projection, found {len(X)}')
+    if n_components < args.components:
+        print(f'Only {len(X)} faces registered; fitting {n_components} components')
+
+    pca = PCA(n_components=n_components).fit(X)
+    np.save(PROJECTION_PATH, pca.components_.astype(np.float32))
+    np.save(PROJECTION_MEAN_PATH, pca.mean_.astype(np.float32))
+    print(f'Saved {pca.components_.shape} projection to {PROJECTION_PATH} '
+          f'({pca.explained_variance_ratio_.sum():.1%} variance kept)')
+
+    # Rows projected with a previous fit are stale; main.py rebuilds them on startup
+    stale = f'db/encodings_pca{n_components}.dat'
+    if os.path.exists(stale):
+        os.remove(stale)
+        print(f'Removed stale {stale}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,45 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from fastapi.responses import ORJSONResponse
+import asyncio
+import httpx
 import threading
-from pydantic import BaseModel
-import base64, io, os, time
-from sqlmodel import SQLModel, Field, Session, create_engine, select
+import binascii, os, sqlite3, time
+from sqlmodel import SQLModel, Field, Session, create_engine, select, func
+from sqlalchemy import event
 import numpy as np
+import orjson
 from typing import List
 import cv2
-from PIL import Image
-from scipy import spatial
 import logging
 
+# SimSIMD provides AVX-512 / NEON distance kernels; fall back to NumPy if missing
+try:
+    import simsimd as simd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+
+# Numba fuses descriptor preprocessing into one pass; fall back to chained NumPy ops
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# FAISS keeps an in-memory inner-product index with a C top-k search; fall back to cdist / GEMM
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -28,88 +51,730 @@ app.add_middleware(
 )
 
 DB_PATH = 'db/face_encodings.db'
+# Copy of the database taken before the one-way legacy encoding migration
+LEGACY_DB_BACKUP_PATH = 'db/face_encodings.legacy.db'
+RAW_ENCODINGS_PATH = 'db/encodings.dat'
+# Optional PCA projection of raw descriptors, written by fit_projection.py
+PROJECTION_PATH = 'db/proj.npy'
+PROJECTION_MEAN_PATH = 'db/proj_mean.npy'
 if not os.path.exists('db'):
     os.makedirs('db')
 
 engine = create_engine(f'sqlite:///{DB_PATH}')
 
+# WAL lets readers (including the RAG service) run alongside a writer, and
+# synchronous=NORMAL skips the per-commit fsync that WAL makes unnecessary.
+# Registered before any connection is opened so every pooled connection gets both.
+@event.listens_for(engine, 'connect')
+def _set_sqlite_pragmas(dbapi_conn, _):
+    dbapi_conn.execute('PRAGMA journal_mode=WAL')
+    dbapi_conn.execute('PRAGMA synchronous=NORMAL')
+
 class Person(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str
-    encoding: bytes
-    registered_at: float
+    # Row of this person's encoding in the EncodingStore matrix
+    row_index: int | None = None
+    registered_at: float = Field(index=True)
 
 SQLModel.metadata.create_all(engine)
+# create_all does not touch existing tables, so add the index explicitly
+with engine.begin() as conn:
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_person_registered_at ON person (registered_at)')
 
-# Load OpenCV face cascade classifier
+# OpenCV face cascade classifier, one per worker thread since
+# CascadeClassifier is not re-entrant
 cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-face_cascade = cv2.CascadeClassifier(cascade_path)
+_cascade_local = threading.local()
+
+# Faces smaller than this are useless for a 128x128 descriptor, so the
+# cascade skips the pyramid levels that could only find them
+MIN_FACE_SIZE = 80
+
+def get_face_cascade():
+    if not hasattr(_cascade_local, 'cascade'):
+        _cascade_local.cascade = cv2.CascadeClassifier(cascade_path)
+    return _cascade_local.cascade
+
+# Prefer the YuNet ONNX detector (OpenCV DNN) when its model file is present;
+# download face_detection_yunet_2023mar.onnx from the OpenCV model zoo
+YUNET_MODEL_PATH = os.environ.get('YUNET_MODEL_PATH', 'models/face_detection_yunet_2023mar.onnx')
+
+YUNET_AVAILABLE = hasattr(cv2, 'FaceDetectorYN') and os.path.exists(YUNET_MODEL_PATH)
+if YUNET_AVAILABLE:
+    logger.info(f"Using YuNet face detector from {YUNET_MODEL_PATH}")
+else:
+    logger.info('YuNet model not available, using Haar cascade for detection')
+
+# setInputSize + detect mutate detector state, so each worker thread gets its own
+_yunet_local = threading.local()
+
+def get_yunet_detector():
+    if not hasattr(_yunet_local, 'detector'):
+        backend, target = cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU
+        try:
+            if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+                backend, target = cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA
+        except Exception:
+            pass
+        _yunet_local.detector = cv2.FaceDetectorYN.create(
+            YUNET_MODEL_PATH, '', (320, 320), 0.9, 0.3, 5000, backend, target)
+    return _yunet_local.detector
+
+def detect_faces(gray, bgr=None):
+    """Return face boxes as a list of (x, y, w, h) ints within the image bounds.
+
+    bgr is the color frame, required for YuNet and only decoded when YuNet is in use.
+    """
+    img_h, img_w = gray.shape[:2]
+    if not YUNET_AVAILABLE:
+        boxes = get_face_cascade().detectMultiScale(
+            gray, scaleFactor=1.2, minNeighbors=5,
+            minSize=(MIN_FACE_SIZE, MIN_FACE_SIZE), maxSize=(min(img_w, img_h),) * 2,
+            flags=cv2.CASCADE_SCALE_IMAGE)
+        return [tuple(int(v) for v in box) for box in boxes]
+    
+    detector = get_yunet_detector()
+    detector.setInputSize((img_w, img_h))
+    _, faces = detector.detect(bgr)
+    if faces is None:
+        return []
+    
+    boxes = []
+    for x, y, w, h in faces[:, :4].astype(int):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, img_w), min(y + h, img_h)
+        if x1 > x0 and y1 > y0:
+            boxes.append((int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+    return boxes
+
+# Raw descriptors are 128x128 grayscale ROIs, flattened and L2-normalized
+RAW_DESCRIPTOR_DIM = 128 * 128
+
+# When a projection (k, RAW_DESCRIPTOR_DIM) is present, descriptors are
+# projected to k dims and re-normalized, and kept in their own store file.
+# The raw descriptor is still written to RAW_ENCODINGS_PATH at the same row,
+# so the projected store can always be rebuilt (or dropped) from it.
+if os.path.exists(PROJECTION_PATH):
+    _projection = np.ascontiguousarray(np.load(PROJECTION_PATH), dtype=np.float32)
+    _projection_mean = (np.load(PROJECTION_MEAN_PATH).astype(np.float32)
+                        if os.path.exists(PROJECTION_MEAN_PATH) else None)
+    DESCRIPTOR_DIM = _projection.shape[0]
+    ENCODINGS_PATH = f'db/encodings_pca{DESCRIPTOR_DIM}.dat'
+    logger.info(f"Projecting descriptors to {DESCRIPTOR_DIM} dims with {PROJECTION_PATH}")
+else:
+    _projection = _projection_mean = None
+    DESCRIPTOR_DIM = RAW_DESCRIPTOR_DIM
+    ENCODINGS_PATH = RAW_ENCODINGS_PATH
+
+# Cosine similarity equivalent of the 0.7 Euclidean threshold for unit vectors:
+# ||a - b||^2 = 2 - 2 a.b  =>  a.b > 1 - 0.7^2 / 2
+# That is calibrated for raw descriptors only. The projection is mean-centered,
+# which spreads cosines out, so re-tune it (MATCH_THRESHOLD env var) for each fit.
+MATCH_THRESHOLD = float(os.environ.get('MATCH_THRESHOLD', 1 - 0.7 ** 2 / 2))
+if _projection is not None and 'MATCH_THRESHOLD' not in os.environ:
+    logger.warning('Projection active with the raw-space MATCH_THRESHOLD; set MATCH_THRESHOLD for the projected space')
+
+# Galleries at least this large are scanned with the early-abort kernel (needs numba)
+EARLY_ABORT_MIN_ROWS = 1000
+EARLY_ABORT_BLOCK = 512
+
+# In-memory cache of all registered encodings as one (N, DESCRIPTOR_DIM) int8 matrix.
+# Bumping _enc_version (on register / delete) forces a rebuild on next use.
+_enc_matrix: np.ndarray | None = None
+_enc_inv_norms: np.ndarray | None = None
+_enc_names: List[str | None] = []
+_enc_version: int = 0
+_enc_loaded_version: int = -1
+_enc_lock = threading.Lock()
+
+def quantize_descriptor(descriptor):
+    """Quantize a float descriptor to int8, scaling its largest component to 127.
+
+    Cosine similarity is scale invariant, so each vector gets its own scale.
+    """
+    peak = float(np.max(np.abs(descriptor))) if descriptor.size else 0.0
+    if peak == 0:
+        return np.zeros(descriptor.shape, dtype=np.int8)
+    return np.clip(np.rint(descriptor * (127.0 / peak)), -128, 127).astype(np.int8)
+
+def project_descriptor(descriptor):
+    """Project a raw descriptor with the PCA projection, if any, and L2 normalize it"""
+    if _projection is None:
+        return descriptor
+    v = descriptor.astype(np.float32)
+    norm = np.linalg.norm(v)
+    if norm > 0:
+        v = v / norm
+    if _projection_mean is not None:
+        v = v - _projection_mean
+    v = _projection @ v
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else v
+
+def to_active_space(raw):
+    """Map a raw int8 descriptor to the int8 descriptor stored and compared by the service"""
+    if _projection is None:
+        return raw
+    return quantize_descriptor(project_descriptor(raw))
+
+def decode_encoding(encoding: bytes):
+    """Decode a legacy BLOB encoding to a raw int8 descriptor, quantizing float32 rows"""
+    if len(encoding) == RAW_DESCRIPTOR_DIM * 4:
+        return quantize_descriptor(np.frombuffer(encoding, dtype=np.float32))
+    return np.frombuffer(encoding, dtype=np.int8)
+
+class EncodingStore:
+    """Append-only (capacity, dim) int8 matrix of encodings in a memory-mapped file.
+
+    Row i holds the encoding of the Person with row_index i, so a recognize
+    pass reads rows [0, size) as one contiguous block with no per-row decoding.
+    Each row's half squared norm ||p||^2 / 2 is kept alongside it, so cosine
+    scoring never recomputes row norms. When faiss is installed, a unit-norm
+    float32 IndexFlatIP mirrors the rows (index id == row) and is kept in step
+    by append / clear; pass with_index=False for a store that is never searched.
+    """
+
+    def __init__(self, path, dim, capacity=1024, with_index=True):
+        self.path = path
+        self.dim = dim
+        self.size = 0
+        self._lock = threading.Lock()
+        self.index = faiss.IndexFlatIP(dim) if FAISS_AVAILABLE and with_index else None
+        self.half_sqnorms = np.zeros(0, dtype=np.float32)
+        if os.path.exists(path):
+            self._open(max(capacity, os.path.getsize(path) // dim), 'r+')
+        else:
+            self._open(capacity, 'w+')
+
+    def _open(self, capacity, mode):
+        # np.memmap grows the backing file when opened with a larger shape
+        self.capacity = capacity
+        self._mm = np.memmap(self.path, dtype=np.int8, mode=mode, shape=(capacity, self.dim))
+        half_sqnorms = np.zeros(capacity, dtype=np.float32)
+        half_sqnorms[:len(self.half_sqnorms)] = self.half_sqnorms
+        self.half_sqnorms = half_sqnorms
+
+    def append(self, vec) -> int:
+        """Write vec to the next free row and return its index"""
+        with self._lock:
+            if self.size == self.capacity:
+                self._mm.flush()
+                self._open(self.capacity * 2, 'r+')
+            row = self.size
+            self._mm[row] = vec
+            self._mm.flush()
+            self.half_sqnorms[row] = 0.5 * float(np.dot(self._mm[row].astype(np.int64), self._mm[row]))
+            self.size += 1
+            if self.index is not None:
+                self.index.add(self._unit_rows(vec))
+            return row
+
+    def write(self, row, vec):
+        """Overwrite an already used row; call rebuild() afterwards to refresh norms and index"""
+        with self._lock:
+            self._mm[row] = vec
+            self._mm.flush()
+
+    def matrix(self):
+        """View of all used rows, without copying"""
+        return self._mm[:self.size]
+
+    def clear(self):
+        with self._lock:
+            self.size = 0
+            if self.index is not None:
+                self.index.reset()
+
+    def _unit_rows(self, vecs):
+        rows = np.array(vecs, dtype=np.float32).reshape(-1, self.dim)
+        faiss.normalize_L2(rows)
+        return rows
+
+    def rebuild(self, chunk=1024):
+        """Recompute row half squared norms and the FAISS index from rows [0, size), a chunk at a time"""
+        with self._lock:
+            if self.index is not None:
+                self.index.reset()
+            for start in range(0, self.size, chunk):
+                rows = self._mm[start:min(start + chunk, self.size)]
+                wide = rows.astype(np.int64)
+                self.half_sqnorms[start:start + len(rows)] = 0.5 * np.einsum('ij,ij->i', wide, wide)
+                if self.index is not None:
+                    self.index.add(self._unit_rows(rows))
+
+    def search(self, queries):
+        """Return (best_scores, best_rows) of the nearest row for each query by cosine similarity"""
+        with self._lock:
+            scores, rows = self.index.search(self._unit_rows(queries), 1)
+        return scores[:, 0], rows[:, 0]
+
+# A projection was just enabled: rebuild the projected store from the raw one
+_project_raw_store = (_projection is not None and not os.path.exists(ENCODINGS_PATH)
+                      and os.path.exists(RAW_ENCODINGS_PATH))
+encoding_store = EncodingStore(ENCODINGS_PATH, DESCRIPTOR_DIM)
+# Source of truth for raw descriptors; the same store when no projection is active
+raw_store = (encoding_store if _projection is None
+             else EncodingStore(RAW_ENCODINGS_PATH, RAW_DESCRIPTOR_DIM, with_index=False))
+# Keeps raw_store and encoding_store rows in step across appends and clears, and
+# orders queued person inserts against /delete-all (see _store_generation)
+_append_lock = threading.RLock()
+# Bumped by every wipe; rows reserved under an older generation are never written
+_store_generation = 0
+
+_stale_projections_dropped = False
+
+def _drop_stale_projections():
+    """Remove projected stores once raw rows change while no projection is active.
+
+    They no longer mirror the raw store, so re-enabling a projection then
+    rebuilds its store from the raw one instead of serving stale rows.
+    Caller holds _append_lock.
+    """
+    global _stale_projections_dropped
+    if _stale_projections_dropped:
+        return
+    _stale_projections_dropped = True
+    for name in os.listdir('db'):
+        if name.startswith('encodings_pca') and name.endswith('.dat'):
+            os.remove(os.path.join('db', name))
+            logger.info(f"Removed stale projected store db/{name}")
+
+def store_descriptor(raw) -> int:
+    """Append a raw int8 descriptor, and its projection if active, and return the shared row"""
+    with _append_lock:
+        if _projection is None:
+            _drop_stale_projections()
+        row = raw_store.append(raw)
+        if raw_store is not encoding_store:
+            projected_row = encoding_store.append(to_active_space(raw))
+            if projected_row != row:
+                raise RuntimeError(f'encoding stores out of step: raw row {row}, projected row {projected_row}')
+        return row
+
+def clear_stores():
+    """Empty both stores and start a new generation"""
+    global _store_generation
+    with _append_lock:
+        if _projection is None:
+            _drop_stale_projections()
+        encoding_store.clear()
+        if raw_store is not encoding_store:
+            raw_store.clear()
+        _store_generation += 1
+
+def migrate_legacy_encodings():
+    """Move encodings out of the old per-row `encoding` BLOB column into the EncodingStore.
+
+    The column is dropped afterwards, so the database is first copied to
+    LEGACY_DB_BACKUP_PATH; restore that file to go back to the BLOB layout.
+    Returns True if a migration ran.
+    """
+    with engine.connect() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(person)')}
+    if 'encoding' not in columns:
+        return False
+    if not os.path.exists(LEGACY_DB_BACKUP_PATH):
+        src, dst = sqlite3.connect(DB_PATH), sqlite3.connect(LEGACY_DB_BACKUP_PATH)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+        logger.info(f"Backed up {DB_PATH} to {LEGACY_DB_BACKUP_PATH} before migrating")
+    with engine.begin() as conn:
+        if 'row_index' not in columns:
+            conn.exec_driver_sql('ALTER TABLE person ADD COLUMN row_index INTEGER')
+        rows = conn.exec_driver_sql('SELECT id, name, encoding FROM person ORDER BY id').fetchall()
+        for person_id, name, encoding in rows:
+            vec = decode_encoding(encoding)
+            if len(vec) != RAW_DESCRIPTOR_DIM:
+                logger.warning(f"Size mismatch for {name}: {len(vec)} vs {RAW_DESCRIPTOR_DIM}, not migrated")
+                continue
+            row = store_descriptor(vec)
+            conn.exec_driver_sql('UPDATE person SET row_index = ? WHERE id = ?', (row, person_id))
+        conn.exec_driver_sql('ALTER TABLE person DROP COLUMN encoding')
+        logger.info(f"Migrated {len(rows)} encodings to {ENCODINGS_PATH}")
+    return True
+
+_migrated = migrate_legacy_encodings()
+with Session(engine) as session:
+    _last_row = session.exec(select(func.max(Person.row_index))).one()
+_stored_rows = 0 if _last_row is None else _last_row + 1
+raw_store.size = _stored_rows
+if _project_raw_store and not _migrated:
+    for _raw in raw_store.matrix():
+        encoding_store.append(to_active_space(_raw))
+    logger.info(f"Projected {_stored_rows} encodings into {ENCODINGS_PATH}")
+encoding_store.size = _stored_rows
+encoding_store.rebuild()
+if raw_store is not encoding_store:
+    # Rows the projected store never received (an all-zero projection) are
+    # projected from their raw descriptor, if one was stored
+    _missing = [row for row in np.flatnonzero(encoding_store.half_sqnorms[:_stored_rows] == 0)
+                if raw_store.matrix()[row].any()]
+    for _row in _missing:
+        encoding_store.write(_row, to_active_space(raw_store.matrix()[_row]))
+    if _missing:
+        encoding_store.rebuild()
+        logger.info(f"Projected {len(_missing)} encodings missing from {ENCODINGS_PATH}")
+
+# Person ids are allocated in-process so /register can answer before its row is written
+with Session(engine) as session:
+    _last_id = session.exec(select(func.max(Person.id))).one()
+_next_person_id = 0 if _last_id is None else _last_id
+_person_id_lock = threading.Lock()
+
+def allocate_person_id() -> int:
+    global _next_person_id
+    with _person_id_lock:
+        _next_person_id += 1
+        return _next_person_id
+
+def invalidate_encodings():
+    """Mark the cached encoding matrix as stale"""
+    global _enc_version
+    with _enc_lock:
+        _enc_version += 1
+
+def load_encodings():
+    """Return (matrix, inv_norms, names) for all registered people, rebuilding the cache if stale.
+
+    names[i] is the person stored in row i, or None for an unclaimed row.
+    """
+    global _enc_matrix, _enc_inv_norms, _enc_names, _enc_loaded_version
+    with _enc_lock:
+        if _enc_matrix is None or _enc_loaded_version != _enc_version:
+            with Session(engine) as session:
+                rows = session.exec(select(Person.name, Person.row_index)).all()
+            _enc_matrix = encoding_store.matrix()
+            names = [None] * len(_enc_matrix)
+            for name, row in rows:
+                if row is not None and row < len(names):
+                    names[row] = name
+            # 1 / ||p|| from the stored ||p||^2 / 2, used by the NumPy fallback
+            norms = np.sqrt(2.0 * encoding_store.half_sqnorms[:len(_enc_matrix)])
+            _enc_inv_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+            _enc_names = names
+            _enc_loaded_version = _enc_version
+            logger.info(f"Loaded {len(rows)} encodings into matrix cache")
+        return _enc_matrix, _enc_inv_norms, _enc_names
+
+def _early_abort_best(matrix, half_sqnorms, query, block, floor):
+    """Return (row, score) of the best cosine match above floor, or (-1, floor).
+
+    Rows are scanned in blocks of dimensions; after each block, Cauchy-Schwarz
+    bounds what the remaining dimensions can add (||p_rest|| * ||q_rest||),
+    and the row is dropped as soon as it cannot beat the best score so far.
+    """
+    n, d = matrix.shape
+    nblocks = (d + block - 1) // block
+    # q_rest[b] = squared norm of the query from block b onwards
+    q_rest = np.zeros(nblocks + 1)
+    for b in range(nblocks - 1, -1, -1):
+        acc = 0
+        for j in range(b * block, min(d, (b + 1) * block)):
+            acc += np.int64(query[j]) * np.int64(query[j])
+        q_rest[b] = q_rest[b + 1] + acc
+    q_norm = np.sqrt(q_rest[0])
+    best_row, best_score = -1, floor
+    if q_norm == 0:
+        return best_row, best_score
+    for i in range(n):
+        p_sq = 2.0 * half_sqnorms[i]
+        if p_sq == 0:
+            continue
+        denom = np.sqrt(p_sq) * q_norm
+        dot = 0
+        p_seen = 0
+        alive = True
+        for b in range(nblocks):
+            for j in range(b * block, min(d, (b + 1) * block)):
+                pj = np.int64(matrix[i, j])
+                dot += pj * np.int64(query[j])
+                p_seen += pj * pj
+            p_rem = max(p_sq - p_seen, 0.0)
+            if (dot + np.sqrt(p_rem * q_rest[b + 1])) / denom <= best_score:
+                alive = False
+                break
+        if alive:
+            best_row, best_score = i, dot / denom
+    return best_row, best_score
+
+if NUMBA_AVAILABLE:
+    _early_abort_best = njit(cache=True)(_early_abort_best)
+
+def best_matches(matrix, inv_norms, queries):
+    """Return (best_rows, best_scores): the most similar matrix row for each int8
+    query descriptor and its cosine similarity.
+
+    All faces are scored in one call so the gallery is streamed through once,
+    instead of once per detected face. Large galleries use the early-abort
+    kernel (needs numba); otherwise FAISS, then SimSIMD, then NumPy.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.int8)
+    if NUMBA_AVAILABLE and len(matrix) >= EARLY_ABORT_MIN_ROWS:
+        # Rows that cannot beat the match threshold are pruned too; a face with
+        # no candidate comes back as row -1
+        half_sqnorms = encoding_store.half_sqnorms[:len(matrix)]
+        found = [_early_abort_best(matrix, half_sqnorms, q, EARLY_ABORT_BLOCK, MATCH_THRESHOLD) for q in queries]
+        return np.array([r for r, _ in found]), np.array([sc for _, sc in found])
+    if encoding_store.index is not None:
+        scores, rows = encoding_store.search(queries)
+        return rows, scores
+    face_idx = np.arange(len(queries))
+    if SIMSIMD_AVAILABLE:
+        dists = np.asarray(simd.cdist(queries, matrix, metric='cosine')).reshape(len(queries), len(matrix))
+        best = dists.argmin(axis=1)
+        # Only each face's winning distance is turned into a similarity
+        return best, 1.0 - dists[face_idx, best]
+    # The row side of the cosine is a multiply by the precomputed 1 / ||p||; the
+    # query norm does not change the argmax, so it only rescales the winner
+    queries = queries.astype(np.float32)
+    scaled = (queries @ matrix.astype(np.float32).T) * inv_norms
+    best = scaled.argmax(axis=1)
+    q_norms = np.linalg.norm(queries, axis=1)
+    winners = scaled[face_idx, best]
+    return best, np.divide(winners, q_norms, out=np.zeros_like(winners), where=q_norms > 0)
 
-def get_face_descriptor(image_array, face_rect):
-    """Extract a simple face descriptor from an image using HOG-like features"""
+def _fuse_descriptor(roi, out):
+    """Convert a flattened uint8 grayscale ROI to float and L2-normalize it into out in one pass.
+
+    The /255 scaling is skipped since it cancels out in the normalization.
+    """
+    n = out.shape[0]
+    sumsq = 0.0
+    for i in range(n):
+        g = float(roi[i])
+        out[i] = g
+        sumsq += g * g
+    if sumsq > 0:
+        inv = 1.0 / np.sqrt(sumsq)
+        for i in range(n):
+            out[i] *= inv
+
+if NUMBA_AVAILABLE:
+    _fuse_descriptor = njit(cache=True, fastmath=True)(_fuse_descriptor)
+
+def get_raw_descriptor(gray_full, face_rect):
+    """Extract the raw int8 face descriptor from the face_rect region of a full grayscale frame"""
     x, y, w, h = face_rect
-    face_roi = image_array[y:y+h, x:x+w]
+    face_roi = gray_full[y:y+h, x:x+w]
     
     # Resize to 128x128 for consistent encoding
     face_roi = cv2.resize(face_roi, (128, 128))
     
-    # Convert to grayscale
-    if len(face_roi.shape) == 3:
-        face_roi = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+    if NUMBA_AVAILABLE:
+        # Flatten and L2 normalize in one fused kernel
+        face_descriptor = np.empty(RAW_DESCRIPTOR_DIM, dtype=np.float32)
+        _fuse_descriptor(np.ascontiguousarray(face_roi).reshape(-1), face_descriptor)
+    else:
+        # Normalize and flatten
+        face_descriptor = face_roi.astype(np.float32) / 255.0
+        face_descriptor = face_descriptor.flatten()
+        
+        # L2 normalize the descriptor
+        norm = np.linalg.norm(face_descriptor)
+        if norm > 0:
+            face_descriptor = face_descriptor / norm
+    
+    # Store and compare as int8 to cut memory traffic by 4x
+    return quantize_descriptor(face_descriptor)
+
+def get_face_descriptor(gray_full, face_rect):
+    """Extract the descriptor used for matching (projected if a projection is active)"""
+    return to_active_space(get_raw_descriptor(gray_full, face_rect))
+
+def decode_image(data: str):
+    """Decode a base64 (optionally data-URI) image to (gray, bgr).
+
+    Descriptors and the Haar cascade work on grayscale, so the image is decoded
+    straight to gray and bgr is None. YuNet is a color model: on that path the
+    image is decoded once as BGR and gray is derived from it.
+    """
+    raw = data.encode('ascii')
+    # Strip a data-URI header through a memoryview to avoid copying the payload;
+    # binascii decodes the view directly where base64.b64decode would copy it
+    start = raw.find(b',') + 1 if raw.startswith(b'data:') else 0
+    buf = np.frombuffer(binascii.a2b_base64(memoryview(raw)[start:]), dtype=np.uint8)
+    if YUNET_AVAILABLE:
+        bgr = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError('could not decode image')
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY), bgr
+    gray = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError('could not decode image')
+    return gray, None
+
+# Shared keep-alive client for notifying the RAG service. Bursts of
+# registrations are coalesced into at most one /ingest per RAG_NOTIFY_INTERVAL.
+RAG_INGEST_URL = 'http://localhost:8002/ingest'
+RAG_NOTIFY_INTERVAL = 2.0
+_rag_client = httpx.AsyncClient(timeout=10.0)
+_rag_notify_pending = False
+_rag_last_notify = 0.0
+_background_tasks = set()
+
+def _spawn(coro):
+    # Keep a reference so fire-and-forget tasks are not garbage collected
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _notify_rag():
+    global _rag_notify_pending, _rag_last_notify
+    loop = asyncio.get_running_loop()
+    delay = _rag_last_notify + RAG_NOTIFY_INTERVAL - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    # Cleared before posting so registrations landing meanwhile schedule another ingest
+    _rag_notify_pending = False
+    _rag_last_notify = loop.time()
+    try:
+        await _rag_client.post(RAG_INGEST_URL)
+    except Exception:
+        pass
+
+def notify_rag():
+    """Ask the RAG service to rebuild its index (non-blocking, debounced)"""
+    global _rag_notify_pending
+    if _rag_notify_pending:
+        return
+    _rag_notify_pending = True
+    _spawn(_notify_rag())
+
+# New Person rows are written by one background task, batched every
+# PERSON_FLUSH_INTERVAL seconds, so /register never waits on a commit
+PERSON_FLUSH_INTERVAL = 0.05
+PERSON_INSERT_CHUNK = 200
+PERSON_WRITE_RETRIES = 3
+_person_queue: asyncio.Queue | None = None
+# Acknowledged registrations not yet written, by person id, so /metadata/* can
+# answer for them: (generation, id, name, row_index, registered_at)
+_pending_people: dict = {}
+# Held across each insert commit and by /delete-all, so a wipe never lands
+# between a batch's generation check and its commit; appends do not take it
+_person_write_lock = threading.Lock()
+
+def _insert_people(batch):
+    """Insert queued (generation, id, name, row_index, registered_at) rows and
+    return how many were written.
+
+    Rows reserved before the last /delete-all are dropped: their encoding rows
+    were wiped and may already belong to someone else.
+    """
+    with _person_write_lock:
+        with _append_lock:
+            live = [person[1:] for person in batch if person[0] == _store_generation]
+        if not live:
+            return 0
+        with engine.begin() as conn:
+            for start in range(0, len(live), PERSON_INSERT_CHUNK):
+                chunk = live[start:start + PERSON_INSERT_CHUNK]
+                values = ', '.join(['(?, ?, ?, ?)'] * len(chunk))
+                params = tuple(v for person in chunk for v in person)
+                conn.exec_driver_sql(f'INSERT INTO person (id, name, row_index, registered_at) VALUES {values}', params)
+    invalidate_encodings()
+    return len(live)
+
+async def _write_people(batch):
+    """Write a batch, retrying with backoff; as a last resort write row by row and
+    log the rows that still fail"""
+    for attempt in range(PERSON_WRITE_RETRIES):
+        try:
+            return await run_in_threadpool(_insert_people, batch)
+        except Exception as e:
+            logger.warning(f"Writing {len(batch)} registrations failed (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(0.1 * 2 ** attempt)
+    written = 0
+    for person in batch:
+        try:
+            written += await run_in_threadpool(_insert_people, [person])
+        except Exception as e:
+            _, person_id, name, row_index, _ = person
+            logger.error(f"Registration {person_id} ({name}) could not be stored, encoding row {row_index} is orphaned: {e}")
+    return written
+
+async def _person_writer():
+    while True:
+        batch = [await _person_queue.get()]
+        await asyncio.sleep(PERSON_FLUSH_INTERVAL)
+        while not _person_queue.empty():
+            batch.append(_person_queue.get_nowait())
+        try:
+            written = await _write_people(batch)
+            logger.info(f"Wrote {written} of {len(batch)} registrations")
+            if written:
+                notify_rag()
+        finally:
+            for person in batch:
+                # Written (or given up on) by now, so the database answers for it
+                _pending_people.pop(person[1], None)
+                _person_queue.task_done()
+
+@app.on_event('startup')
+async def _start_person_writer():
+    global _person_queue
+    _person_queue = asyncio.Queue()
+    _spawn(_person_writer())
+
+@app.on_event('shutdown')
+async def _flush_person_writer():
+    await _person_queue.join()
+    await _rag_client.aclose()
+
+async def read_json_body(request: Request, fields=('image',)) -> dict:
+    """Parse the request body with orjson and check that each of fields is a string.
+
+    /register and /recognize carry multi-MB base64 images, so they read the
+    body directly instead of validating it through a Pydantic model.
+    """
+    body = orjson.loads(await request.body())
+    if not isinstance(body, dict):
+        raise ValueError('request body must be a JSON object')
+    for field in fields:
+        if not isinstance(body.get(field), str):
+            raise ValueError(f'request body must have a "{field}" string')
+    return body
+
+def _encode_and_store(image):
+    """Detect the first face in image, append its encoding to the store and
+    return (reserved row, store generation), or None if no face was found"""
+    # decode image
+    gray, bgr = decode_image(image)
     
-    # Normalize and flatten
-    face_descriptor = face_roi.astype(np.float32) / 255.0
-    face_descriptor = face_descriptor.flatten()
+    # Detect faces
+    boxes = detect_faces(gray, bgr)
     
-    # L2 normalize the descriptor
-    norm = np.linalg.norm(face_descriptor)
-    if norm > 0:
-        face_descriptor = face_descriptor / norm
+    if len(boxes) == 0:
+        return None
     
-    return face_descriptor
-
-class RegisterRequest(BaseModel):
-    name: str
-    image: str  # base64
+    # Get descriptor for the first face
+    x, y, w, h = boxes[0]
+    descriptor = get_raw_descriptor(gray, (x, y, w, h))
+    with _append_lock:
+        return store_descriptor(descriptor), _store_generation
 
 @app.post('/register')
-def register(req: RegisterRequest):
+async def register(request: Request):
     try:
-        # decode image
-        header, b64 = req.image.split(',', 1) if req.image.startswith('data:') else (None, req.image)
-        img_bytes = base64.b64decode(b64)
-        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-        arr = np.array(img)
-        gray = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
-        
-        # Detect faces
-        boxes = face_cascade.detectMultiScale(gray, 1.3, 5)
-        
-        if len(boxes) == 0:
+        body = await read_json_body(request, fields=('image', 'name'))
+        name = body['name']
+        # Image work is CPU-bound, so keep it off the event loop
+        stored = await run_in_threadpool(_encode_and_store, body['image'])
+        if stored is None:
             return {'error': 'no_face_detected'}
+        row, generation = stored
+        if generation != _store_generation:
+            return {'error': 'registration interrupted by delete-all, please retry'}
         
-        # Get descriptor for the first face
-        x, y, w, h = boxes[0]
-        encoding = get_face_descriptor(arr, (x, y, w, h))
-        
-        # store
-        with Session(engine) as session:
-            p = Person(name=req.name, encoding=encoding.tobytes(), registered_at=time.time())
-            session.add(p)
-            session.commit()
-            session.refresh(p)
-        
-        # Notify RAG service to rebuild index (non-blocking)
-        def _notify_rag():
-            try:
-                requests.post('http://localhost:8002/ingest', timeout=10)
-            except Exception:
-                pass
-
-        try:
-            threading.Thread(target=_notify_rag, daemon=True).start()
-        except Exception:
-            pass
+        # store: the encoding row and person id are reserved now, and the SQL
+        # insert (followed by the RAG notification) happens in the background
+        p = Person(id=allocate_person_id(), name=name, row_index=row, registered_at=time.time())
+        queued = (generation, p.id, p.name, p.row_index, p.registered_at)
+        _pending_people[p.id] = queued
+        _person_queue.put_nowait(queued)
 
         from datetime import datetime
         timestamp = datetime.fromtimestamp(p.registered_at).isoformat()
@@ -117,64 +782,45 @@ def register(req: RegisterRequest):
     except Exception as e:
         return {'error': str(e)}
 
-class RecognizeRequest(BaseModel):
-    image: str
-
-@app.post('/recognize')
-def recognize(req: RecognizeRequest):
-    try:
-        header, b64 = req.image.split(',', 1) if req.image.startswith('data:') else (None, req.image)
-        img_bytes = base64.b64decode(b64)
-        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-        arr = np.array(img)
-        gray = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+def _recognize_image(image):
+    """Detect every face in image and return its box and best-matching name"""
+    gray, bgr = decode_image(image)
+    
+    # Detect faces
+    boxes = detect_faces(gray, bgr)
+    logger.info(f"Detected {len(boxes)} faces")
+    
+    matrix, inv_norms, names = load_encodings()
+    logger.info(f"Found {len(names)} registered people")
+    
+    results = []
+    if len(boxes) > 0:
+        faces = np.stack([get_face_descriptor(gray, box) for box in boxes])
+        logger.info(f"Extracted {len(faces)} descriptors of size {faces.shape[1]}")
         
-        # Detect faces
-        boxes = face_cascade.detectMultiScale(gray, 1.3, 5)
-        logger.info(f"Detected {len(boxes)} faces")
+        if names:
+            # One batched call scores every face against every known person
+            best, best_scores = best_matches(matrix, inv_norms, faces)
         
-        results = []
-        with Session(engine) as session:
-            people = session.exec(select(Person)).all()
-            logger.info(f"Found {len(people)} registered people")
+        for i, (x, y, w, h) in enumerate(boxes):
+            name = 'Unknown'
+            if names:
+                best_match_idx = int(best[i])
+                best_sim = float(best_scores[i])
+                # The index may hold a row registered after names was loaded
+                known = 0 <= best_match_idx < len(names) and names[best_match_idx] is not None
+                if known and best_sim > MATCH_THRESHOLD:
+                    name = names[best_match_idx]
+                    logger.info(f"Face {i}: recognized as {name} with similarity {best_sim:.4f}")
             
-            for i, (x, y, w, h) in enumerate(boxes):
-                enc = get_face_descriptor(arr, (x, y, w, h))
-                logger.info(f"Face {i}: descriptor size = {len(enc)}")
-                name = 'Unknown'
-                
-                if people:
-                    # Calculate distances to all known faces
-                    min_distance = float('inf')
-                    best_match_idx = -1
-                    
-                    for idx, person in enumerate(people):
-                        try:
-                            known_enc = np.frombuffer(person.encoding, dtype=np.float32)
-                            logger.info(f"Person {idx} ({person.name}): stored descriptor size = {len(known_enc)}")
-                            
-                            # Ensure sizes match before comparing
-                            if len(known_enc) != len(enc):
-                                logger.warning(f"Size mismatch for {person.name}: {len(known_enc)} vs {len(enc)}")
-                                continue
-                            
-                            distance = spatial.distance.euclidean(enc, known_enc)
-                            logger.info(f"Distance to {person.name}: {distance:.4f}")
-                            
-                            if distance < min_distance:
-                                min_distance = distance
-                                best_match_idx = idx
-                        except Exception as match_err:
-                            logger.error(f"Error comparing with {person.name}: {match_err}")
-                            continue
-                    
-                    # Use a threshold for recognition (0.7 is a reasonable threshold for normalized descriptors)
-                    if best_match_idx >= 0 and min_distance < 0.7:
-                        name = people[best_match_idx].name
-                        logger.info(f"Recognized as {name} with distance {min_distance:.4f}")
-                
-                results.append({'box': [int(x), int(y), int(w), int(h)], 'name': name})
-        
+            results.append({'box': [int(x), int(y), int(w), int(h)], 'name': name})
+    return results
+
+@app.post('/recognize')
+async def recognize(request: Request):
+    try:
+        body = await read_json_body(request)
+        results = await run_in_threadpool(_recognize_image, body['image'])
         return {'results': results}
     except Exception as e:
         import traceback
@@ -182,27 +828,52 @@ def recognize(req: RecognizeRequest):
         logger.error(f"Recognition error: {error_msg}\n{traceback.format_exc()}")
         return {'error': error_msg, 'results': []}
 
+def _live_pending_people():
+    """Snapshot of acknowledged registrations the writer has not stored yet"""
+    return [p for p in list(_pending_people.values()) if p[0] == _store_generation]
+
 @app.get('/metadata/last')
 def last_registered():
+    pending = _live_pending_people()
     with Session(engine) as session:
         r = session.exec(select(Person).order_by(Person.registered_at.desc()).limit(1)).first()
-        if not r:
-            return {'none': True}
-        return {'id': r.id, 'name': r.name, 'registered_at': r.registered_at}
+    newest = max(pending, key=lambda p: p[4], default=None)
+    if newest is not None and (not r or newest[4] >= r.registered_at):
+        return {'id': newest[1], 'name': newest[2], 'registered_at': newest[4]}
+    if not r:
+        return {'none': True}
+    return {'id': r.id, 'name': r.name, 'registered_at': r.registered_at}
 
 @app.get('/metadata/count')
 def count():
-    with Session(engine) as session:
-        c = session.exec(select(Person)).all()
-        return {'count': len(c)}
+    # The snapshot is taken first: a pending row committed since then is
+    # counted once, by one statement that also tells which ids already landed
+    ids = [p[1] for p in _live_pending_people()]
+    with engine.connect() as conn:
+        if not ids:
+            return {'count': conn.exec_driver_sql('SELECT COUNT(*) FROM person').one()[0]}
+        marks = ', '.join(['?'] * len(ids))
+        total, landed = conn.exec_driver_sql(
+            f'SELECT COUNT(*), COALESCE(SUM(id IN ({marks})), 0) FROM person', tuple(ids)).one()
+    return {'count': total + len(ids) - landed}
 
-@app.delete('/delete-all')
-def delete_all():
-    """Delete all registered persons from the database"""
-    try:
+def _delete_all_people():
+    # Waits for an insert in flight, then holds off appends for the wipe itself
+    with _person_write_lock, _append_lock:
         with Session(engine) as session:
             session.query(Person).delete()
             session.commit()
+        clear_stores()
+        _pending_people.clear()
+    invalidate_encodings()
+
+@app.delete('/delete-all')
+async def delete_all():
+    """Delete all registered persons from the database"""
+    try:
+        # Registrations still queued or in flight belong to the old generation
+        # and are dropped instead of being written after the wipe
+        await run_in_threadpool(_delete_all_people)
         return {'status': 'success', 'message': 'All persons deleted'}
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
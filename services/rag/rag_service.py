@@ -1,11 +1,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List
 import os
 import sqlite3
+import threading
 import time
 import logging
+import orjson
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Try optional imports for LangChain/FAISS/OpenAI. We'll fallback to simple LLM prompt if not available.
@@ -34,7 +38,7 @@ except Exception:
 # Load .env file (if present)
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Allow CORS for frontend / node proxy
 app.add_middleware(
@@ -118,37 +122,85 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 FACE_DB = os.path.abspath(os.path.join(BASE_DIR, '..', 'face_recog', 'db', 'face_encodings.db'))
 
 
-def fetch_people_from_db() -> List[dict]:
+# One shared read-only connection; SQLite connections are not safe for
+# concurrent use, so access goes through _conn_lock
+_conn: sqlite3.Connection | None = None
+_conn_lock = threading.Lock()
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(FACE_DB, check_same_thread=False)
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA query_only=1')
+        _conn = conn
+    return _conn
+
+
+@lru_cache(maxsize=4096)
+def _fmt(ts: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+def fetch_people_from_db(limit: int | None = None, after_id: int | None = None) -> List[dict]:
     """Read registration metadata directly from face_recog sqlite DB.
-    Returns list of dicts with keys: id, name, registered_at, timestamp
+    Returns list of dicts with keys: id, name, registered_at, timestamp, oldest first.
+    With limit, only the most recent `limit` registrations are returned; with
+    after_id, only registrations whose id is greater than after_id.
     """
     if not os.path.exists(FACE_DB):
         logger.warning('Face DB not found at %s', FACE_DB)
         return []
     try:
-        conn = sqlite3.connect(FACE_DB)
-        cur = conn.cursor()
-        # Try common table name 'person' used by SQLModel
-        cur.execute("SELECT id, name, registered_at FROM person ORDER BY registered_at ASC")
-        rows = cur.fetchall()
-        conn.close()
-        
-        from datetime import datetime
-        result = []
-        for r in rows:
-            timestamp_readable = datetime.fromtimestamp(r[2]).strftime('%Y-%m-%d %H:%M:%S')
-            result.append({
-                'id': r[0], 
-                'name': r[1], 
-                'registered_at': r[2],
-                'timestamp': timestamp_readable
-            })
-        return result
+        with _conn_lock:
+            cur = _get_connection().cursor()
+            # Try common table name 'person' used by SQLModel
+            where, params = ("WHERE id > ? ", (after_id,)) if after_id is not None else ("", ())
+            if limit is None:
+                cur.execute(f"SELECT id, name, registered_at FROM person {where}ORDER BY registered_at ASC", params)
+            else:
+                cur.execute(f"SELECT id, name, registered_at FROM person {where}ORDER BY registered_at DESC LIMIT ?",
+                            params + (limit,))
+            # Build the dicts straight off the cursor instead of materializing rows first
+            result = [
+                {'id': r[0], 'name': r[1], 'registered_at': r[2], 'timestamp': _fmt(r[2])}
+                for r in cur
+            ]
+        return result if limit is None else result[::-1]
     except Exception as e:
         logger.error('Error reading DB: %s', e)
         return []
 
 
+def fetch_recent_docs_text(n: int = 10) -> str:
+    """Return the n most recent registrations, newest first, as newline-joined
+    prompt lines, formatted straight from the cursor.
+    """
+    if not os.path.exists(FACE_DB):
+        logger.warning('Face DB not found at %s', FACE_DB)
+        return ''
+    try:
+        with _conn_lock:
+            cur = _get_connection().execute(
+                "SELECT id, name, registered_at FROM person ORDER BY registered_at DESC LIMIT ?", (n,))
+            return "\n".join(f"ID: {r[0]} | Name: {r[1]} | Registered: {_fmt(r[2])}" for r in cur)
+    except Exception as e:
+        logger.error('Error reading DB: %s', e)
+        return ''
+
+
+def count_people_in_db() -> int:
+    if not os.path.exists(FACE_DB):
+        return 0
+    try:
+        with _conn_lock:
+            return _get_connection().execute("SELECT COUNT(*) FROM person").fetchone()[0]
+    except Exception as e:
+        logger.error('Error reading DB: %s', e)
+        return 0
+
+
 @app.get('/health')
 def health():
     return {
@@ -167,36 +219,139 @@ def _build_documents(people: List[dict]) -> List[str]:
     return docs
 
 
+# Identity of the set embedded in the saved index: the highest person id, how
+# many rows it holds and when that highest-id person registered. /ingest only
+# embeds newer rows while the database still agrees with all three; ids are
+# reused after /delete-all, so max_id and a count alone can match a different set.
+INDEX_STATE_PATH = os.path.join(INDEX_DIR, 'index_state.json')
+# Serializes every write of the saved index and its state file
+_ingest_lock = threading.Lock()
+
+
+def _read_index_state() -> dict | None:
+    try:
+        with open(INDEX_STATE_PATH, 'rb') as f:
+            state = orjson.loads(f.read())
+        return state if {'max_id', 'count', 'registered_at'} <= state.keys() else None
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _write_index_state(people: List[dict], count: int):
+    if people:
+        newest = max(people, key=lambda p: p['id'])
+        state = {'max_id': newest['id'], 'count': count, 'registered_at': newest['registered_at']}
+        with open(INDEX_STATE_PATH, 'wb') as f:
+            f.write(orjson.dumps(state))
+
+
+def _index_matches_db(state: dict, ntotal: int) -> bool:
+    """True if the rows with id <= state['max_id'] are exactly the indexed ones"""
+    with _conn_lock:
+        count, registered_at = _get_connection().execute(
+            "SELECT COUNT(*), MAX(CASE WHEN id = ? THEN registered_at END) FROM person WHERE id <= ?",
+            (state['max_id'], state['max_id'])).fetchone()
+    return ntotal == state['count'] == count and registered_at == state['registered_at']
+
+
+def _build_index(embeddings):
+    """Embed every registration into a fresh index and save it; caller holds _ingest_lock"""
+    people = fetch_people_from_db()
+    # Metadata - map each doc to its person id
+    vectorstore = FAISS.from_texts(_build_documents(people), embeddings, metadatas=_metadatas(people))
+    vectorstore.save_local(INDEX_DIR)
+    _write_index_state(people, len(people))
+    return len(people)
+
+
+def _metadatas(people: List[dict]) -> List[dict]:
+    return [{'id': p['id'], 'name': p['name'], 'registered_at': p['registered_at']} for p in people]
+
+
+# Cached QA chain (over the loaded vector store), reloaded when index.faiss changes on disk
+_vs_cache = {'qa': None, 'embeddings': None, 'mtime': 0}
+_vs_lock = threading.Lock()
+
+
+def _invalidate_vectorstore():
+    with _vs_lock:
+        _vs_cache['qa'] = None
+        _vs_cache['mtime'] = 0
+
+
+def _get_qa_chain():
+    """Return the shared RetrievalQA chain, (re)loading the FAISS index only when it changed."""
+    index_path = os.path.join(INDEX_DIR, 'index.faiss')
+    with _vs_lock:
+        if _vs_cache['embeddings'] is None:
+            _vs_cache['embeddings'] = get_embeddings_instance()
+        embeddings = _vs_cache['embeddings']
+
+    if not os.path.exists(index_path):
+        # Build on the fly if index missing; _ingest_lock is taken before _vs_lock,
+        # as in /ingest, and the check is repeated in case /ingest just built it
+        with _ingest_lock:
+            if not os.path.exists(index_path):
+                _build_index(embeddings)
+
+    with _vs_lock:
+        mtime = os.path.getmtime(index_path)
+        if _vs_cache['qa'] is None or mtime != _vs_cache['mtime']:
+            vectorstore = FAISS.load_local(INDEX_DIR, embeddings)
+            retriever = vectorstore.as_retriever(search_type='similarity', search_kwargs={'k': 4})
+            llm = OpenAI(openai_api_key=_get_openai_key(), temperature=0)
+            _vs_cache['qa'] = RetrievalQA.from_chain_type(llm=llm, chain_type='stuff', retriever=retriever)
+            _vs_cache['mtime'] = mtime
+        return _vs_cache['qa']
+
+
 @app.post('/ingest')
 def ingest():
     """Ingest/index registration data from the face_recog database into a vector store.
-    If LangChain + OpenAI embeddings are not available, return a simple status.
+    Only registrations newer than the last indexed id are embedded and appended;
+    the index is rebuilt from scratch when it no longer matches the database
+    (e.g. after /delete-all). If LangChain + embeddings are not available,
+    return a simple status.
     """
-    people = fetch_people_from_db()
-    if not people:
+    total = count_people_in_db()
+    if not total:
         return {'status': 'no_data', 'count': 0}
 
-    docs = _build_documents(people)
-
     # Try to obtain embeddings instance (prefers Google, falls back to OpenAI)
     try:
         embeddings = get_embeddings_instance()
     except Exception as e:
         logger.info('No embeddings provider available for ingest: %s', e)
-        return {'status': 'ok', 'count': len(docs), 'backend': 'simple', 'message': str(e)}
+        return {'status': 'ok', 'count': total, 'backend': 'simple', 'message': str(e)}
 
-    try:
-        # Create FAISS index using the chosen embeddings
-        # Metadata - map each doc to its person id
-        metadatas = [{'id': p['id'], 'name': p['name'], 'registered_at': p['registered_at']} for p in people]
+    with _ingest_lock:
+        try:
+            state = _read_index_state()
+            vectorstore = None
+            if state is not None and os.path.exists(os.path.join(INDEX_DIR, 'index.faiss')):
+                vectorstore = FAISS.load_local(INDEX_DIR, embeddings)
+                if not _index_matches_db(state, vectorstore.index.ntotal):
+                    logger.info('Vector index out of sync with face DB, rebuilding')
+                    vectorstore = None
+
+            if vectorstore is None:
+                # Create FAISS index using the chosen embeddings
+                added = _build_index(embeddings)
+            else:
+                people = fetch_people_from_db(after_id=state['max_id'])
+                if not people:
+                    return {'status': 'ok', 'count': total, 'added': 0, 'backend': 'faiss'}
+                vectorstore.add_texts(_build_documents(people), metadatas=_metadatas(people))
+                vectorstore.save_local(INDEX_DIR)
+                _write_index_state(people, vectorstore.index.ntotal)
+                added = len(people)
 
-        vectorstore = FAISS.from_texts(docs, embeddings, metadatas=metadatas)
-        vectorstore.save_local(INDEX_DIR)
+            _invalidate_vectorstore()
 
-        return {'status': 'ok', 'count': len(docs), 'backend': 'faiss'}
-    except Exception as e:
-        logger.exception('Failed to build vector index: %s', e)
-        return {'status': 'error', 'message': str(e)}
+            return {'status': 'ok', 'count': total, 'added': added, 'backend': 'faiss'}
+        except Exception as e:
+            logger.exception('Failed to build vector index: %s', e)
+            return {'status': 'error', 'message': str(e)}
 
 
 @app.post('/query')
@@ -205,26 +360,14 @@ def query(req: QueryRequest):
     Falls back to the simple prompt approach (Gemini) if vector store or LLM are not configured.
     """
     logger.info('Processing query: %s', req.query)
-    people = fetch_people_from_db()
-    if not people:
+    total = count_people_in_db()
+    if not total:
         return {'answer': 'No registration data available.', 'sources_count': 0, 'backend': 'none'}
 
     # Prefer vector search + LLM
     if LANGCHAIN_AVAILABLE:
         try:
-            embeddings = get_embeddings_instance()
-            if os.path.exists(os.path.join(INDEX_DIR, 'index.faiss')):
-                vectorstore = FAISS.load_local(INDEX_DIR, embeddings)
-            else:
-                # Build on the fly if index missing
-                docs = _build_documents(people)
-                metadatas = [{'id': p['id'], 'name': p['name'], 'registered_at': p['registered_at']} for p in people]
-                vectorstore = FAISS.from_texts(docs, embeddings, metadatas=metadatas)
-                vectorstore.save_local(INDEX_DIR)
-
-            retriever = vectorstore.as_retriever(search_type='similarity', search_kwargs={'k': 4})
-            llm = OpenAI(openai_api_key=_get_openai_key(), temperature=0)
-            qa = RetrievalQA.from_chain_type(llm=llm, chain_type='stuff', retriever=retriever)
+            qa = _get_qa_chain()
             answer = qa.run(req.query)
             return {'answer': answer, 'sources_count': 4, 'backend': 'faiss+openai'}
         except Exception as e:
@@ -232,11 +375,8 @@ def query(req: QueryRequest):
 
     # Fallback: simple prompt using Gemini if available, otherwise a local template
     try:
-        last_n = people[-10:]
-        docs_text = []
-        for p in reversed(last_n):
-            docs_text.append(f"ID: {p['id']} | Name: {p['name']} | Registered: {p['timestamp']}")
-        joined = "\n".join(docs_text)
+        joined = fetch_recent_docs_text(10)
+        sources_count = min(total, 10)
 
         system_prompt = "You are a friendly, helpful assistant that answers questions about face registrations. Include timestamps when asked about when people were registered. Keep responses concise and personable."
         prompt = f"{system_prompt}\n\nRegistration records:\n{joined}\n\nQuestion: {req.query}\n\nAnswer in a friendly way (one or two sentences)."
@@ -244,17 +384,18 @@ def query(req: QueryRequest):
         # Prefer Gemini if configured
         if GOOGLE_GENAI_AVAILABLE and _get_google_api_key():
             answer = generate_with_gemini(prompt)
-            return {'answer': answer, 'sources_count': len(last_n), 'backend': 'gemini_fallback'}
+            return {'answer': answer, 'sources_count': sources_count, 'backend': 'gemini_fallback'}
 
         # Final fallback: simple local heuristic
         # Example: answer simple known queries
         q = req.query.lower()
         if 'last' in q and 'registered' in q:
+            last_n = fetch_people_from_db(limit=1)
             last = last_n[-1] if last_n else None
             if last:
                 return {'answer': f"The last registered person is {last['name']} at {last['timestamp']}", 'sources_count': 1, 'backend': 'local'}
         if 'how many' in q or 'count' in q:
-            return {'answer': f"There are {len(people)} registered people.", 'sources_count': len(people), 'backend': 'local'}
+            return {'answer': f"There are {total} registered people.", 'sources_count': total, 'backend': 'local'}
 
         return {'answer': 'Unable to answer precisely without configured LLM/embeddings; please enable OpenAI or Gemini keys.', 'sources_count': 0, 'backend': 'local'}
     except Exception as e: